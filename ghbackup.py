@@ -1,13 +1,29 @@
 from __future__ import annotations
 import argparse
+import json
+import os
+import random
 import re
 import sys
+import threading
+import time
 from typing import Any
 from datetime import datetime, timezone, timedelta
+from collections import deque
 from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    # Optional, but parses GitHub's JSON responses faster than the json module
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
 
 
 session = requests.Session()
@@ -16,28 +32,198 @@ session = requests.Session()
 session.headers["Accept"] = "application/vnd.github+json"
 session.headers["X-GitHub-Api-Version"] = "2022-11-28"
 
+# Downloading is slow mostly because we wait for GitHub to respond, so we fetch
+# comments of several issues/PRs at once. GitHub doesn't like too many
+# concurrent requests, so keep this small.
+PARALLEL_DOWNLOADS = 4
+
+# Retry if GitHub has temporary problems: connection errors and 500, 502, 503
+# and 504 responses. There's a short wait before each retry, and it doubles
+# every time. If retrying doesn't help, we get the error response and
+# raise_for_status() fails as usual. Other responses, including 403 and 429,
+# are never retried here.
+#
+# Rate limits are handled only in get_page(), because all threads need to wait
+# for them. So urllib3 must ignore Retry-After. Otherwise it would retry a 429
+# response with Retry-After by itself, and sleep in a way that other threads
+# and Ctrl+C don't know about.
+_retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+    respect_retry_after_header=False,
+    raise_on_status=False,
+)
+# One connection for each download thread. All requests, including the ones
+# that list issues and PRs, are made in those threads. Connections are reused,
+# so we don't need a new TLS handshake for each request.
+session.mount("https://", HTTPAdapter(pool_maxsize=PARALLEL_DOWNLOADS, max_retries=_retry))
+
+# Compiled once here, because some of these are used in loops
+_GITHUB_URL_RE = re.compile(r"https://github\.com/([^/]+)/([^/]+)")
+_GITHUB_ID_RE = re.compile(rb"GitHub ID: (\d+)\r?\n")  # start of comment files
+_UPDATED_RE = re.compile(r"^Updated: (.*)$", flags=re.MULTILINE)  # in info.txt files
+
+
+def parse_json(response: requests.Response) -> Any:
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+# GitHub sends an ETag with each response. If we send it back next time and
+# nothing has changed, GitHub responds with "304 Not Modified" and no content.
+# Conditional requests like that don't count against the rate limit when a
+# token is used.
+class ETagCache:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        # URL --> (etag, whether there is a next page)
+        self.old: dict[str, tuple[str, bool]] = {}
+        self.new: dict[str, tuple[str, bool]] = {}
 
-def issues_and_prs(owner: str, repo: str, since: datetime | None) -> Iterator[dict[str, Any]]:
+        try:
+            with path.open("r", encoding="utf-8") as file:
+                for url, (etag, has_next_page) in json.load(file).items():
+                    if not isinstance(etag, str) or not isinstance(has_next_page, bool):
+                        raise ValueError(f"bad etags.json entry: {url!r}")
+                    self.old[url] = (etag, has_next_page)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, AttributeError):
+            # The file is corrupt (json.JSONDecodeError is a ValueError) or has
+            # the wrong structure. Without etags, we just download everything again.
+            self.old.clear()
+
+    # Call this only after everything has been saved. Otherwise we could get
+    # "304 Not Modified" for something that was never saved.
+    def save(self) -> None:
+        if self.new != self.old:
+            # Write to a temporary file first, so that etags.json is never left half-written.
+            temp_path = self.path.with_name(self.path.name + ".tmp")
+            with temp_path.open("w", encoding="utf-8") as file:
+                json.dump(self.new, file, indent=2, sort_keys=True)
+                file.write("\n")
+            os.replace(temp_path, self.path)
+
+
+# When we hit GitHub's rate limit, all threads wait until GitHub allows more requests.
+# https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+_rate_limit_lock = threading.Lock()
+_rate_limit_resume_time = 0.0
+_stop_waiting = threading.Event()  # set when something fails, e.g. Ctrl+C
+
+
+def pause_for_rate_limit(seconds: float) -> None:
+    global _rate_limit_resume_time
+    if seconds <= 0:
+        # Happens when the rate limit has already reset
+        return
+    with _rate_limit_lock:
+        resume_time = time.time() + seconds
+        if resume_time > _rate_limit_resume_time:
+            _rate_limit_resume_time = resume_time
+            print(f"  Hit GitHub's rate limit, waiting {round(seconds)} seconds...")
+
+
+def wait_for_rate_limit() -> None:
+    while True:
+        with _rate_limit_lock:
+            delay = _rate_limit_resume_time - time.time()
+        if delay <= 0:
+            return
+        if _stop_waiting.wait(delay):
+            raise RuntimeError("stopped waiting for rate limit")
+
+
+# Returns how many seconds to wait before trying again, or None if the response
+# is not a rate limit error.
+def rate_limit_delay(r: requests.Response, attempt: int) -> float | None:
+    if r.status_code not in (403, 429):
+        return None
+    if "Retry-After" in r.headers:
+        return int(r.headers["Retry-After"])
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+        # +1 in case our clock is a bit behind GitHub's clock
+        return int(r.headers["X-RateLimit-Reset"]) - time.time() + 1
+    if r.status_code == 429 or "secondary rate limit" in r.text:
+        # GitHub says to wait at least a minute, and longer if it keeps happening
+        return 60 * 2**attempt + random.uniform(0, 5)
+    return None
+
+
+# Returns the results and whether there are more pages. If the page is the same
+# as last time, its results have already been saved, and the returned list is
+# empty. Without etags, the page is always downloaded.
+def get_page(url: str, etags: ETagCache | None) -> tuple[list[dict[str, Any]], bool]:
+    headers = {}
+    if etags is not None and url in etags.old:
+        headers["If-None-Match"] = etags.old[url][0]
+
+    for attempt in range(5):
+        wait_for_rate_limit()
+        r = session.get(url, headers=headers)
+        delay = rate_limit_delay(r, attempt)
+        # After the last attempt, raise_for_status() below fails without waiting
+        if delay is None or attempt == 4:
+            break
+        pause_for_rate_limit(delay)
+    r.raise_for_status()
+
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+        # The next request would fail, so don't even try it before the reset
+        pause_for_rate_limit(int(r.headers["X-RateLimit-Reset"]) - time.time() + 1)
+
+    if r.status_code == 304:
+        assert etags is not None
+        etags.new[url] = etags.old[url]
+        return [], etags.old[url][1]
+
+    # GitHub includes a link to the next page only if there is one. Checking
+    # that is better than checking for a full page, because then an exactly
+    # full last page doesn't cost an extra request for an empty page.
+    results: list[dict[str, Any]] = parse_json(r)
+    has_next_page = "next" in r.links
+    if etags is not None and "ETag" in r.headers:
+        etags.new[url] = (r.headers["ETag"], has_next_page)
+    return results, has_next_page
+
+
+def issues_and_prs(
+    owner: str,
+    repo: str,
+    since: str | None,
+    etags: ETagCache,
+    executor: ThreadPoolExecutor,
+) -> Iterator[dict[str, Any]]:
+    url = f"https://api.github.com/repos/{owner}/{repo}/issues"
     query_params: dict[str, Any] = {
         "state": "all",  # open and closed
-        "page": 1,
         "per_page": 100,
     }
     if since is not None:
-        assert since.tzinfo == timezone.utc
-        query_params["since"] = since.isoformat(timespec='seconds')
+        query_params["since"] = since
+
+    # Only the page number changes, so the rest of the URL is built only once
+    url += "?" + urlencode(query_params)
+
+    page = 1
+    future = executor.submit(get_page, f"{url}&page={page}", etags)
 
     while True:
-        r = session.get(f"https://api.github.com/repos/{owner}/{repo}/issues", params=query_params)
-        r.raise_for_status()
+        results, has_next_page = future.result()
+
+        # Start downloading the next page while the caller handles this page
+        if has_next_page:
+            page += 1
+            future = executor.submit(get_page, f"{url}&page={page}", etags)
 
-        results: list[dict[str, Any]] = r.json()
         for result in results:
             yield result
 
-        if len(results) < query_params["per_page"]:
+        if not has_next_page:
             break
-        query_params["page"] += 1
 
 
 # Example: 2 pages of 100 results are needed for 105 results, so ceildiv(105, 100) == 2.
@@ -52,66 +238,166 @@ assert ceildiv(100, 100) == 1
 assert ceildiv(101, 100) == 2
 
 
-def iter_comments(issue_or_pr: dict[str, Any], since: datetime | None) -> Iterator[dict[str, Any]]:
-    yield issue_or_pr  # The issue/pr JSON itself has same fields that comments have
-
+# Starts downloading all pages of comments in the background. This can be
+# done in parallel, because GitHub tells us how many comments there are.
+#
+# We don't use etags for comments. The URL contains the since parameter, and it
+# changes whenever an issue or PR changes, which is also the only time when we
+# download its comments. So the same URL would never be requested again.
+def start_downloading_comments(
+    issue_or_pr: dict[str, Any],
+    since: str | None,
+    executor: ThreadPoolExecutor,
+) -> list[Future[tuple[list[dict[str, Any]], bool]]]:
     query_params: dict[str, Any] = {"per_page": 100}
     if since is not None:
-        assert since.tzinfo == timezone.utc
-        query_params["since"] = since.isoformat(timespec='seconds')
+        query_params["since"] = since
 
+    url = issue_or_pr["comments_url"] + "?" + urlencode(query_params)
     num_pages = ceildiv(issue_or_pr["comments"], query_params["per_page"])
-    for page in range(1, num_pages + 1):
-        query_params["page"] = page
-        r = session.get(issue_or_pr["comments_url"], params=query_params)
-        r.raise_for_status()
-        for result in r.json():
-            yield result
+    return [executor.submit(get_page, f"{url}&page={page}", None) for page in range(1, num_pages + 1)]
 
 
-def save_comment(comment: dict[str, Any], folder: Path) -> None:
-    # TODO: use comment["reactions"]
-    author = comment["user"]["login"]
-    next_number = 1
-    number = None
+def iter_comments(
+    issue_or_pr: dict[str, Any],
+    pages: list[Future[tuple[list[dict[str, Any]], bool]]],
+) -> Iterator[dict[str, Any]]:
+    yield issue_or_pr  # The issue/pr JSON itself has same fields that comments have
 
-    for path in folder.iterdir():
-        if not path.is_file():
-            continue
+    for page in pages:
+        results, _ = page.result()
+        for result in results:
+            yield result
 
-        m = re.fullmatch(r"(\d+)_(.*)\.txt", path.name)
-        if not m:
-            continue
 
-        next_number = max(int(m.group(1)) + 1, next_number)
+# Scans the folder once, so that saving each comment doesn't need to do it again.
+# Returns {GitHub ID: (number, file name)}, and the number for the next new comment.
+#
+# Each file is opened once here to read its GitHub ID, so that saving a comment
+# doesn't need to open other comment files.
+def index_comment_files(folder: Path) -> tuple[dict[int, tuple[int, str]], int]:
+    files_by_id: dict[int, tuple[int, str]] = {}
+    next_number = 1
 
-        if m.group(2) == author:
-            with path.open("r", encoding="utf-8") as file:
-                if file.readline() == f"GitHub ID: {comment['id']}\n":
-                    number = int(m.group(1))
-                    print(f"      Comment number {number} from {author} has been downloaded already, overwriting")
-                    path.unlink()
-                    break
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # The file type comes from the directory listing, so this doesn't
+            # need a separate stat() call for each file
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            # Comment files are named like 0003_Akuli.txt. This runs for every
+            # file in the folder, and plain string methods are faster than a regex.
+            number_str, underscore, _ = entry.name.partition("_")
+            if not (underscore and number_str.isdecimal() and entry.name.endswith(".txt")):
+                continue
+
+            number = int(number_str)
+            next_number = max(number + 1, next_number)
+
+            # The GitHub ID is at the start of the file. Reading a few bytes
+            # is much cheaper than creating a text file object for one line.
+            fd = os.open(entry.path, os.O_RDONLY)
+            try:
+                start = os.read(fd, 64)
+            finally:
+                os.close(fd)
+            id_match = _GITHUB_ID_RE.match(start)
+            if id_match:
+                files_by_id[int(id_match.group(1))] = (number, entry.name)
+
+    return files_by_id, next_number
+
+
+# Returns the new next_number
+def save_comment(
+    comment: dict[str, Any],
+    folder: Path,
+    files_by_id: dict[int, tuple[int, str]],
+    next_number: int,
+) -> int:
+    # TODO: use comment["reactions"]
+    author = comment["user"]["login"]
 
-    if number is None:
+    old_name: str | None
+    if comment["id"] in files_by_id:
+        number, old_name = files_by_id[comment["id"]]
+    else:
         number = next_number
+        next_number += 1
+        old_name = None
         print(f"      New comment number {number} from {author}")
 
     file_path = folder / f"{number:04}_{author}.txt"
 
-    with file_path.open("w", encoding="utf-8") as file:
-        file.write(f"GitHub ID: {comment['id']}\n")
-        file.write(f"Author: {author}\n")
-        file.write(f"Created: {comment['created_at']}\n")
-        file.write("\n")
-
-        # Fix GitHub weirdness:
-        #  - issue description/body may be null
-        #  - issue description/body does not necessarily end with \n
-        body = comment["body"] or ""
-        if not body.endswith("\n"):
-            body += "\n"
-        file.write(body)
+    # Fix GitHub weirdness:
+    #  - issue description/body may be null
+    #  - issue description/body does not necessarily end with \n
+    body = comment["body"] or ""
+    if not body.endswith("\n"):
+        body += "\n"
+
+    # Encode once and write bytes, so that everything goes to the file in one
+    # write without the overhead of a text file.
+    content = (
+        f"GitHub ID: {comment['id']}\n"
+        f"Author: {author}\n"
+        f"Created: {comment['created_at']}\n"
+        "\n"
+        + body
+    ).encode("utf-8")
+
+    if old_name is not None:
+        # Most comments are never edited. Reading is much cheaper than writing.
+        if old_name == file_path.name and file_path.read_bytes() == content:
+            print(f"      Comment number {number} from {author} has been downloaded already, no changes")
+            return next_number
+        print(f"      Comment number {number} from {author} has been downloaded already, overwriting")
+
+    # If something goes wrong while writing (e.g. Ctrl+C or disk full), we
+    # don't want a comment file that contains only half of the comment.
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    temp_path.write_bytes(content)
+    os.replace(temp_path, file_path)
+
+    # Usually the old file was replaced above, but not if the author has
+    # changed their GitHub username.
+    if old_name is not None and old_name != file_path.name:
+        (folder / old_name).unlink()
+
+    files_by_id[comment["id"]] = (number, file_path.name)
+    return next_number
+
+
+def save_issue_or_pr(
+    issue_or_pr: dict[str, Any],
+    folder: Path,
+    folder_is_new: bool,
+    comments: Iterator[dict[str, Any]] | None,
+) -> None:
+    if "pull_request" in issue_or_pr:
+        print(f"  Found PR #{issue_or_pr['number']}: {issue_or_pr['title']}")
+    else:
+        print(f"  Found issue #{issue_or_pr['number']}: {issue_or_pr['title']}")
+
+    if comments is None:
+        print("    Already up to date")
+        return
+
+    if folder_is_new:
+        # Nothing to scan, we just created the folder
+        files_by_id: dict[int, tuple[int, str]] = {}
+        next_number = 1
+    else:
+        files_by_id, next_number = index_comment_files(folder)
+
+    for comment in comments:
+        print(f"    Found comment from {comment['user']['login']}")
+        next_number = save_comment(comment, folder, files_by_id, next_number)
+
+    # Write info after all comments, so that the issue or pull request
+    # is not considered to be up-to-date if something errors
+    (folder / "info.txt").write_text(f"Title: {issue_or_pr['title']}\nUpdated: {issue_or_pr['updated_at']}\n")
 
 
 def update_repo(repo_folder: Path) -> None:
@@ -137,52 +423,79 @@ def update_repo(repo_folder: Path) -> None:
                 since -= timedelta(minutes=10)  # in case clocks are out of sync
                 print(f"  Updating only what has changed since {since}.")
 
-    m = re.fullmatch(r"https://github.com/([^/]+)/([^/]+)", github_url)
+    # Same for all requests, so convert it to what GitHub wants only once
+    since_param = None
+    if since is not None:
+        assert since.tzinfo == timezone.utc
+        since_param = since.isoformat(timespec='seconds')
+
+    m = _GITHUB_URL_RE.fullmatch(github_url)
     if not m:
         raise ValueError(f"bad GitHub URL: {github_url!r}")
     user, reponame = m.groups()
 
+    etags = ETagCache(repo_folder / "etags.json")
     some_issue_or_pr_changed = False
 
-    for issue_or_pr in issues_and_prs(user, reponame, since):
-        if "pull_request" in issue_or_pr:
-            print(f"  Found PR #{issue_or_pr['number']}: {issue_or_pr['title']}")
-            issue_or_pr_folder = repo_folder / f"pr_{issue_or_pr['number']:05}"
-        else:
-            print(f"  Found issue #{issue_or_pr['number']}: {issue_or_pr['title']}")
-            issue_or_pr_folder = repo_folder / f"issue_{issue_or_pr['number']:05}"
-
-        issue_or_pr_folder.mkdir(exist_ok=True)
-
-        last_updated = None
-        try:
-            with (issue_or_pr_folder / "info.txt").open("r") as file:
-                for line in file:
-                    if line.startswith("Updated: "):
-                        last_updated = line.split(": ")[1].strip()
-                        break
-        except FileNotFoundError:
-            pass
-
-        if issue_or_pr["updated_at"] == last_updated:
-            print("    Already up to date")
-            continue
-        some_issue_or_pr_changed = True
-
-        for comment in iter_comments(issue_or_pr, since):
-            print(f"    Found comment from {comment['user']['login']}")
-            save_comment(comment, issue_or_pr_folder)
-
-        # Write info after all comments, so that the issue or pull request
-        # is not considered to be up-to-date if something errors
-        with (issue_or_pr_folder / "info.txt").open("w") as file:
-            file.write(f"Title: {issue_or_pr['title']}\n")
-            file.write(f"Updated: {issue_or_pr['updated_at']}\n")
+    # Comments are downloaded in worker threads, but saved in the same order
+    # as the issues and PRs come from GitHub, so output doesn't get mixed up.
+    # The list of pages is None if the issue or PR is already up to date.
+    pending: deque[tuple[dict[str, Any], Path, bool, list[Future[tuple[list[dict[str, Any]], bool]]] | None]] = deque()
+
+    def save_first_pending() -> None:
+        issue_or_pr, issue_or_pr_folder, folder_is_new, pages = pending.popleft()
+        comments = None if pages is None else iter_comments(issue_or_pr, pages)
+        save_issue_or_pr(issue_or_pr, issue_or_pr_folder, folder_is_new, comments)
+
+    executor = ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOADS)
+    try:
+        for issue_or_pr in issues_and_prs(user, reponame, since_param, etags, executor):
+            if "pull_request" in issue_or_pr:
+                issue_or_pr_folder = repo_folder / f"pr_{issue_or_pr['number']:05}"
+            else:
+                issue_or_pr_folder = repo_folder / f"issue_{issue_or_pr['number']:05}"
+
+            try:
+                issue_or_pr_folder.mkdir()
+                folder_is_new = True
+            except FileExistsError:
+                folder_is_new = False
+
+            last_updated = None
+            if not folder_is_new:
+                try:
+                    # The file is tiny, so reading it all at once is fastest
+                    m = _UPDATED_RE.search((issue_or_pr_folder / "info.txt").read_text())
+                    if m:
+                        last_updated = m.group(1).strip()
+                except FileNotFoundError:
+                    pass
+
+            if issue_or_pr["updated_at"] == last_updated:
+                pending.append((issue_or_pr, issue_or_pr_folder, folder_is_new, None))
+            else:
+                some_issue_or_pr_changed = True
+                pages = start_downloading_comments(issue_or_pr, since_param, executor)
+                pending.append((issue_or_pr, issue_or_pr_folder, folder_is_new, pages))
+
+            # Don't download too far ahead of what has been saved
+            while pending and (pending[0][3] is None or len(pending) > 2 * PARALLEL_DOWNLOADS):
+                save_first_pending()
+
+        while pending:
+            save_first_pending()
+    except BaseException:
+        # Worker threads shouldn't keep waiting for the rate limit
+        _stop_waiting.set()
+        raise
+    finally:
+        # If something errors, don't keep downloading in the background
+        executor.shutdown(cancel_futures=True)
 
     if some_issue_or_pr_changed:
-        with repo_info_txt.open("w") as file:
-            file.write(f"GitHub URL: {github_url}\n")
-            file.write(f"Updated: {start_time}\n")
+        repo_info_txt.write_text(f"GitHub URL: {github_url}\nUpdated: {start_time}\n")
+
+    etags.save()
 
 
 def main() -> None: